@@ -21,19 +21,67 @@ import logging
 import sys
 import time
 import os
+import re
+import hashlib
+import threading
+import tempfile
+import functools
 import xml.etree.ElementTree as ET
-import multiprocessing.pool as pool
+from concurrent.futures import ThreadPoolExecutor
 
 # local imports
 import execute as ex
-import logpipe as lp
+
+
+# Remote scripts are fed to 'bash -s' so that each phase costs one round trip.
+# The script itself is on stdin, so commands that could read from it (vim in
+# setup.py, git, make) get /dev/null instead.
+SETUP_SCRIPT = '''set -e
+git clone https://github.com/utah-scs/splinter.git < /dev/null
+cd splinter
+git checkout {0} < /dev/null
+./scripts/setup.py --full < /dev/null > /dev/null 2>&1
+'''
+
+BUILD_SCRIPT = '''set -e
+cd splinter
+git checkout {0} < /dev/null
+git pull < /dev/null
+source ~/.cargo/env
+make < /dev/null > /dev/null 2>&1
+'''
+
+SERVER_NIC_SCRIPT = '''set -e
+cd splinter
+cp db/server.toml-example db/server.toml
+sed -E -i -e 's/01:02:03:04:05:06/{0}/;' -e 's/0000:04:00.1/{1}/;' db/server.toml
+'''
+
+CLIENT_NIC_SCRIPT = '''set -e
+cd splinter
+echo "server_mac: {0}" >> nic_info
+./scripts/create-client-toml < /dev/null
+'''
+
+# 'pci: <addr>' and 'mac: <addr>' lines of the nic_info written by setup.py
+NIC_INFO_RE = re.compile(r'^(pci|mac):?\s+(\S+)', re.M)
+
+# vnode is an emulab extension, it is not in the namespace of the rspec
+VNODE_TAG = '{http://www.protogeni.net/resources/rspec/ext/emulab/1}vnode'
+
+# ssh masters are shared by every Host of the same user and machine. Each
+# control path has a lock guarding its master, and is in _masters while that
+# master is up.
+_masterLocks = {}
+_masters = set()
 
 
 class Host(object):
-    def __init__(self, name, id, hostName):
+    def __init__(self, name, id, hostName, publicName=None):
         self.__name = name
         self.__id = id
         self.__hostName = hostName
+        self.__publicName = publicName or name + '.utah.cloudlab.us'
         self.__logger = logging.getLogger("cluster." + self.__id)
 
     def setupLogger(self, logDirName, level):
@@ -44,58 +92,135 @@ class Host(object):
         self.__logger.info("Begin Logging!")
 
     def getPublicName(self):
-        return self.__name + '.utah.cloudlab.us'
+        return self.__publicName
 
     def dump(self, level, logger):
-        self.__logger.log(level, '\t\tName: ' + self.__name)
-        self.__logger.log(level, '\t\tId: ' + self.__id)
-        self.__logger.log(level, '\t\thostName: ' + self.__hostName)
+        self.__logger.log(level, '\t\tName: %s', self.__name)
+        self.__logger.log(level, '\t\tId: %s', self.__id)
+        self.__logger.log(level, '\t\thostName: %s', self.__hostName)
+
+    # ssh multiplexing, one master per user and host. The socket name is a
+    # short hash to stay below the unix socket path length limit.
+    def __controlPath(self, user):
+        digest = hashlib.sha1(self.__target(user).encode("UTF-8")).hexdigest()
+        return os.path.expanduser('~/.ssh/cm-{}.sock'.format(digest[:12]))
+
+    def __ensureMaster(self, user, options=()):
+        controlPath = self.__controlPath(user)
+        with _masterLocks.setdefault(controlPath, threading.Lock()):
+            if controlPath in _masters:
+                return
+
+            # The master is forked into the background, so it must not hold
+            # on to any of our pipes or they would never see EOF. Its stderr
+            # goes to a file instead, which is logged once ssh returns.
+            cmd = ['ssh', '-o', 'ControlMaster=auto', '-o', 'ControlPersist=10m',
+                   '-o', 'ControlPath=' + controlPath]
+            cmd += options
+            cmd += ['-N', '-f', self.__target(user)]
+            with tempfile.TemporaryFile() as errFile:
+                process = subprocess.run(cmd,
+                                         stdin=subprocess.DEVNULL,
+                                         stdout=subprocess.DEVNULL,
+                                         stderr=errFile,
+                                         close_fds=True)
+                errFile.seek(0)
+                for line in errFile.read().decode("UTF-8", "replace").splitlines():
+                    self.__logger.error(line)
+
+            if process.returncode:
+                self.__logger.error('Failed to open ssh master connection: %s', ' '.join(cmd))
+                raise ex.SubprocessException(cmd, process.returncode)
+            _masters.add(controlPath)
+
+    def __target(self, user):
+        return '{0}@{1}'.format(user, self.getPublicName())
+
+    # the remote command is a single argument, it is only parsed by the
+    # remote shell
+    def __sshCommand(self, user, cmd):
+        self.__ensureMaster(user)
+        return ['ssh', '-o', 'ControlPath=' + self.__controlPath(user),
+                '-o', 'ControlMaster=no', self.__target(user), cmd]
+
+    def connect(self, user):
+        # this flag adds the host to the known hosts file automatically
+        self.__ensureMaster(user, ['-o', 'StrictHostKeyChecking=no'])
 
     def execute(self, user, cmd):
-        cmd = 'ssh {0}@{1} {2}'.format(user, self.getPublicName(), cmd)
-        ex.execute(cmd, self.__logger)
+        ex.execute(self.__sshCommand(user, cmd), self.__logger)
+
+    def executeScript(self, user, script, capture=False):
+        cmd = self.__sshCommand(user, 'bash -s')
+        return ex.execute(cmd, self.__logger, script=script, capture=capture)
+
+    def stream(self, user, cmd):
+        return ex.stream(self.__sshCommand(user, cmd), self.__logger)
+
+    def close(self, user):
+        controlPath = self.__controlPath(user)
+        with _masterLocks.setdefault(controlPath, threading.Lock()):
+            if controlPath not in _masters:
+                return
+
+            cmd = ['ssh', '-O', 'exit', '-o', 'ControlPath=' + controlPath,
+                   self.__target(user)]
+            subprocess.run(cmd,
+                           stdin=subprocess.DEVNULL,
+                           stdout=subprocess.DEVNULL,
+                           stderr=subprocess.DEVNULL,
+                           close_fds=True)
+            _masters.discard(controlPath)
+
+
+# module level, so that it can be pickled along with the tasks of a pool
+def _executeOnHost(method, args, host):
+    return method(host, *args)
 
 
 class HostPool(object):
     def __init__(self):
         self.__hosts = []
+        self.__pool = None
 
     def setupLogger(self, logDirName, level):
         for host in self.__hosts:
             host.setupLogger(logDirName, level)
 
     def dump(self, level, logger):
-        for _, host in enumerate(self.__hosts):
+        for i, host in enumerate(self.__hosts):
+            logger.log(level, '\t%d:', i)
             host.dump(level, logger)
 
     def addHost(self, host):
         self.__hosts.append(host)
 
-    def execute(self, user, cmd):
-        tpool = pool.ThreadPool(processes=len(self.__hosts))
-        async_results = []
+    def close(self, user):
+        if self.__pool is not None:
+            self.__pool.shutdown()
+            self.__pool = None
+
         for host in self.__hosts:
-            def wrapExecute(host, user, cmd):
-                try:
-                    host.execute(user, cmd)
-                except ex.SubprocessException as e:
-                    return e
-
-            async_result = tpool.apply_async(
-                wrapExecute, (host, user, cmd))
-            async_results.append(async_result)
-
-        for async_result in async_results:
-            return_val = async_result.get()
-            if return_val == None:
-                continue
-            elif isinstance(return_val, ex.SubprocessException):
-                raise return_val
-            elif isinstance(return_val, Exception):
-                raise return_val
-            else:
-                raise Exception(
-                    'Unrecognized return value from ssh: {0}'.format(str(return_val)))
+            host.close(user)
+
+    def connect(self, user):
+        self.__executeEach(Host.connect, user)
+
+    def execute(self, user, cmd):
+        self.__executeEach(Host.execute, user, cmd)
+
+    def executeScript(self, user, script):
+        self.__executeEach(Host.executeScript, user, script)
+
+    def __executeEach(self, method, *args):
+        # the pool is kept across calls, hosts are only known once the
+        # manifest has been parsed
+        if self.__pool is None:
+            self.__pool = ThreadPoolExecutor(max_workers=len(self.__hosts))
+
+        # map re-raises the exception of the first host, in order, that failed
+        func = functools.partial(_executeOnHost, method, args)
+        list(self.__pool.map(func, self.__hosts))
 
 
 class Cluster(object):
@@ -105,36 +230,52 @@ class Cluster(object):
         self.__clients = HostPool()
         self.__user = user
 
-        cmd = 'ssh {0}@{1} /usr/bin/geni-get manifest'.format(
-            self.__user, server)
-        errPipe = lp.LogPipe(self.__logger, logging.ERROR)
-        completedProcess = subprocess.run(cmd,
-                                          shell=True,
-                                          stdin=subprocess.PIPE,
-                                          stdout=subprocess.PIPE,
-                                          stderr=errPipe,
-                                          close_fds=True)
-        errPipe.close()
-
-        root = ET.fromstring(completedProcess.stdout.decode("UTF-8"))
-        for xmlNode in list(root):
-            if not xmlNode.tag.endswith('node'):
-                continue
-
-            for child in list(xmlNode):
-                if child.tag.endswith('host'):
-                    hostName = child.get('name')
-
-                if child.tag.endswith('vnode'):
-                    name = child.get('name')
-
-            id = xmlNode.get('client_id')
-            if id == 'server' and self.__server == None:
-                self.__server = Host(name, id, hostName)
-            else:
-                self.__clients.addHost(Host(name, id, hostName))
-        if server == None:
-            raise Exception("No server found!")
+        # server and clients phases run concurrently on this pool. Unlike a
+        # multiprocessing ThreadPool, a future also carries the SystemExit
+        # raised when a phase fails, instead of hanging the caller.
+        self.__pool = ThreadPoolExecutor(max_workers=2)
+
+        # The manifest is fetched through the master of the given host, so
+        # the later commands to that host reuse its connection.
+        self.__gateway = Host(server, 'manifest', server, publicName=server)
+        # the gateway master outlives us unless it is closed, and main only
+        # registers Cluster.close once the cluster has been set up
+        try:
+            with self.__gateway.stream(self.__user, '/usr/bin/geni-get manifest') as manifest:
+                # Nodes are handled as soon as they have been received. The root
+                # is then cleared, which drops the node along with every other
+                # element read so far, so the manifest is never held in memory
+                # as a whole.
+                root = None
+                for event, xmlNode in ET.iterparse(manifest, events=('start', 'end')):
+                    if root is None:
+                        # the root element carries the rspec namespace
+                        root = xmlNode
+                        ns = xmlNode.tag[:xmlNode.tag.rfind('}') + 1]
+                        nodeTag = ns + 'node'
+                        hostTag = ns + 'host'
+
+                    if event != 'end' or xmlNode.tag != nodeTag:
+                        continue
+
+                    for child in list(xmlNode):
+                        if child.tag == hostTag:
+                            hostName = child.get('name')
+
+                        if child.tag == VNODE_TAG:
+                            name = child.get('name')
+
+                    id = xmlNode.get('client_id')
+                    if id == 'server' and self.__server == None:
+                        self.__server = Host(name, id, hostName)
+                    else:
+                        self.__clients.addHost(Host(name, id, hostName))
+                    root.clear()
+            if self.__server == None:
+                raise Exception("No server found!")
+        except Exception:
+            self.__gateway.close(self.__user)
+            raise
         self
 
     def setupLogger(self, logDirName, level):
@@ -153,10 +294,21 @@ class Cluster(object):
         self.__logger.log(level, 'clients:')
         self.__clients.dump(level, self.__logger)
 
+    def close(self):
+        self.__pool.shutdown()
+        self.__server.close(self.__user)
+        self.__clients.close(self.__user)
+        self.__gateway.close(self.__user)
+
     def checkAuth(self):
-        # this flag adds the server to the known hosts file automatically
-        self.__server.execute('-o StrictHostKeyChecking=no {}'.format(self.__user), '')
-        self.__clients.execute('-o StrictHostKeyChecking=no {}'.format(self.__user), '')
+        # Authenticate with every host once, in parallel. The master
+        # connections are then shared by every later phase.
+        serverRes = self.__pool.submit(self.__server.connect, self.__user)
+        clientsRes = self.__pool.submit(self.__clients.connect, self.__user)
+
+        # Wait for both to complete
+        serverRes.result()
+        clientsRes.result()
 
     def __executeOnServer(self, cmd):
         self.__server.execute(self.__user, cmd)
@@ -164,24 +316,29 @@ class Cluster(object):
     def __executeOnClients(self, cmd):
         self.__clients.execute(self.__user, cmd)
 
+    def __executeScriptOnServer(self, script, capture=False):
+        return self.__server.executeScript(self.__user, script, capture)
+
+    def __executeScriptOnClients(self, script):
+        self.__clients.executeScript(self.__user, script)
+
     def setup(self, branch):
         # Setup clients and servers in parallel
-        tpool = pool.ThreadPool(processes=2)
-        serverRes = tpool.apply_async(self.__setupServer, (branch,))
-        clientsRes = tpool.apply_async(self.__setupClients, (branch,))
+        serverRes = self.__pool.submit(self.__setupServer, branch)
+        clientsRes = self.__pool.submit(self.__setupClients, branch)
 
         # Wait for both to complete
-        serverRes.get()
-        clientsRes.get()
-        self.__setupNIC()
+        nicInfo = serverRes.result()
+        clientsRes.result()
+        self.__setupNIC(nicInfo)
 
     def __setupServer(self, branch):
         try:
             self.__logger.info("Server setup started...")
-            self.__executeOnServer('"git clone https://github.com/utah-scs/splinter.git"')
-            self.__executeOnServer('"cd splinter; git checkout {0}"'.format(branch))
-            self.__executeOnServer('"cd splinter; ./scripts/setup.py --full > /dev/null 2>&1"')
+            nicInfo = self.__executeScriptOnServer(
+                SETUP_SCRIPT.format(branch) + 'cat nic_info\n', capture=True)
             self.__logger.info('Server setup concluded.')
+            return nicInfo
 
         except Exception as e:
             self.__logger.error('Server setup failed!')
@@ -191,9 +348,7 @@ class Cluster(object):
     def __setupClients(self, branch):
         try:
             self.__logger.info("Clients setup started...")
-            self.__executeOnClients('"git clone https://github.com/utah-scs/splinter.git"')
-            self.__executeOnClients('"cd splinter; git checkout {0}"'.format(branch))
-            self.__executeOnClients('"cd splinter; ./scripts/setup.py --full > /dev/null 2>&1"')
+            self.__executeScriptOnClients(SETUP_SCRIPT.format(branch))
 
             self.__logger.info('Clients setup concluded.')
 
@@ -202,25 +357,22 @@ class Cluster(object):
             self.__logger.error(str(e))
             exit(1)
 
-    def __setupNIC(self):
+    def __setupNIC(self, nicInfo):
         try:
             self.__logger.info("NIC setup started...")
-            self.__executeOnServer('"cd splinter; cat nic_info" > nic_info')  # beware, dirty trick. nic_info is local
 
-            pci = subprocess.check_output("awk '/^pci/ { print $2; }' < nic_info", shell=True).decode("UTF-8").rstrip()
+            nic = dict(NIC_INFO_RE.findall(nicInfo))
+
+            pci = nic.get('pci')
             if not pci:
                 raise Exception("Failed to gather pci!")
 
-            mac = subprocess.check_output("awk '/^mac/ { print $2; }' < nic_info", shell=True).decode("UTF-8").rstrip()
+            mac = nic.get('mac')
             if not mac:
                 raise Exception("Failed to gather mac!")
 
-            self.__executeOnServer('"cd splinter; cp db/server.toml-example db/server.toml; \
-                                 sed -E -i \'s/01:02:03:04:05:06/' + mac + '/;\' db/server.toml; \
-                                 sed -E -i \'s/0000:04:00.1/' + pci + '/;\' db/server.toml"')
-            self.__executeOnClients('"cd splinter; \
-                                 echo "server_mac: ' + mac + '" >> nic_info; \
-                                 ./scripts/create-client-toml"')
+            self.__executeScriptOnServer(SERVER_NIC_SCRIPT.format(mac, pci))
+            self.__executeScriptOnClients(CLIENT_NIC_SCRIPT.format(mac))
 
             self.__logger.info('NIC setup concluded.')
 
@@ -231,18 +383,17 @@ class Cluster(object):
 
     def wipe(self):
         # Wipe clients and servers in parallel
-        tpool = pool.ThreadPool(processes=2)
-        serverRes = tpool.apply_async(self.__wipeServer, ())
-        clientsRes = tpool.apply_async(self.__wipeClients, ())
+        serverRes = self.__pool.submit(self.__wipeServer)
+        clientsRes = self.__pool.submit(self.__wipeClients)
 
         # Wait for both to complete
-        serverRes.get()
-        clientsRes.get()
+        serverRes.result()
+        clientsRes.result()
 
     def __wipeServer(self):
         try:
             self.__logger.info("Server wipe started...")
-            self.__executeOnServer('"rm -rf splinter"')
+            self.__executeOnServer('rm -rf splinter')
             self.__logger.info("Server wipe concluded...")
 
         except Exception as e:
@@ -253,7 +404,7 @@ class Cluster(object):
     def __wipeClients(self):
         try:
             self.__logger.info("Clients wipe started...")
-            self.__executeOnClients('"rm -rf splinter"')
+            self.__executeOnClients('rm -rf splinter')
             self.__logger.info("Clients wipe concluded...")
 
         except Exception as e:
@@ -263,20 +414,17 @@ class Cluster(object):
 
     def build(self, branch):
         # Build clients and servers in parallel
-        tpool = pool.ThreadPool(processes=2)
-        serverRes = tpool.apply_async(self.__buildServer, (branch,))
-        clientsRes = tpool.apply_async(self.__buildClients, (branch,))
+        serverRes = self.__pool.submit(self.__buildServer, branch)
+        clientsRes = self.__pool.submit(self.__buildClients, branch)
 
         # Wait for both to complete
-        serverRes.get()
-        clientsRes.get()
+        serverRes.result()
+        clientsRes.result()
 
     def __buildServer(self, branch):
         try:
             self.__logger.info("Server build started...")
-            self.__executeOnServer('"cd splinter; git checkout {0}"'.format(branch))
-            self.__executeOnServer('"cd splinter; git pull"')
-            self.__executeOnServer('"cd splinter; source ~/.cargo/env; make > /dev/null 2>&1;"')
+            self.__executeScriptOnServer(BUILD_SCRIPT.format(branch))
             self.__logger.info("Server build concluded...")
 
         except Exception as e:
@@ -287,9 +435,7 @@ class Cluster(object):
     def __buildClients(self, branch):
         try:
             self.__logger.info("Clients build started...")
-            self.__executeOnClients('"cd splinter; git checkout {0}"'.format(branch))
-            self.__executeOnClients('"cd splinter; git pull"')
-            self.__executeOnClients('"cd splinter; source ~/.cargo/env; make > /dev/null 2>&1;"')
+            self.__executeScriptOnClients(BUILD_SCRIPT.format(branch))
             self.__logger.info("Clients build concluded...")
 
         except Exception as e:
@@ -299,13 +445,12 @@ class Cluster(object):
 
     def kill(self, extension):
         # Kill clients and servers in parallel
-        tpool = pool.ThreadPool(processes=2)
-        serverRes = tpool.apply_async(self.__killServer, ())
-        clientsRes = tpool.apply_async(self.__killClients, (extension,))
+        serverRes = self.__pool.submit(self.__killServer)
+        clientsRes = self.__pool.submit(self.__killClients, extension)
 
         # Wait for both to complete
-        serverRes.get()
-        clientsRes.get()
+        serverRes.result()
+        clientsRes.result()
 
     def __killServer(self):
         # TODO @jmbarzee implement kill server
@@ -314,7 +459,7 @@ class Cluster(object):
     def __killClients(self, ext):
         try:
             self.__logger.info("Clients kill started...")
-            self.__executeOnServer('"sudo kill -9 `pidof {0}`"'.format(ext))
+            self.__executeOnServer('sudo kill -9 `pidof {0}`'.format(ext))
             self.__logger.info("Clients kill concluded...")
 
         except Exception as e:
@@ -325,7 +470,7 @@ class Cluster(object):
     def startServer(self):
         try:
             self.__logger.info("Server start started...")
-            self.__executeOnServer('"cd splinter; sudo scripts/run-server &"')
+            self.__executeOnServer('cd splinter; sudo scripts/run-server &')
             self.__logger.info("Server start concluded...")
 
         except Exception as e:
@@ -337,8 +482,8 @@ class Cluster(object):
         try:
             self.__logger.info("run YSCB started...")
             for rate in rates:
-                self.__logger.info("\tYSCB({0})".format(rate))
-                self.__executeOnClients('"cd splinter; sudo ./scripts/run-ycsb {0}"'.format(rate))
+                self.__logger.info("\tYSCB(%d)", rate)
+                self.__executeOnClients('cd splinter; sudo ./scripts/run-ycsb {0}'.format(rate))
             self.__logger.info("run YSCB concluded...")
 
         except Exception as e:
@@ -349,7 +494,7 @@ class Cluster(object):
     def runAuth(self, rates):
         try:
             self.__logger.info("run Auth started...")
-            self.__executeOnClients('"cd splinter; sudo ./scripts/run-auth"')
+            self.__executeOnClients('cd splinter; sudo ./scripts/run-auth')
             self.__logger.info("run Auth concluded...")
 
         except Exception as e:
@@ -15,6 +15,7 @@
 # OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
 
 import argparse
+import contextlib
 import subprocess
 import pprint
 import logging
@@ -32,6 +33,10 @@ class SubprocessException(Exception):
     def __init__(self, cmd, returnCode):
         self.cmd = cmd
         self.returnCode = returnCode
+        if not isinstance(cmd, str):
+            cmd = ' '.join(cmd)
+        self.msg = "'{0}' failed with return code {1}".format(cmd, returnCode)
+        super(SubprocessException, self).__init__(self.msg)
 
 
 class RemoteSubprocessException(SubprocessException):
@@ -40,17 +45,51 @@ class RemoteSubprocessException(SubprocessException):
         super(RemoteSubprocessException, self).__init__(cmd, returnCode)
 
 
-def execute(cmd, logger):
-    outPipe = lp.LogPipe(logger, logging.INFO)
+# cmd is either a shell command line or an argv list, which is run without
+# going through a local shell
+def execute(cmd, logger, script=None, capture=False):
+    outPipe = None if capture else lp.LogPipe(logger, logging.INFO)
     errPipe = lp.LogPipe(logger, logging.ERROR)
     process = subprocess.run(cmd,
-                               shell=True,
-                               stdin=subprocess.PIPE,
-                               stdout=outPipe,
+                               shell=isinstance(cmd, str),
+                               input=script.encode("UTF-8") if script else b'',
+                               stdout=subprocess.PIPE if capture else outPipe,
                                stderr=errPipe,
                                close_fds=True)
-    outPipe.close()
+    if outPipe is not None:
+        outPipe.close()
     errPipe.close()
 
+    output = None
+    if capture:
+        output = process.stdout.decode("UTF-8")
+        for line in output.splitlines():
+            logger.info(line)
+
     if process.returncode:
-        raise SubprocessException(cmd, process.returncode)
\ No newline at end of file
+        raise SubprocessException(cmd, process.returncode)
+    return output
+
+
+# runs cmd and yields its stdout as a file, so the output can be consumed
+# while the command is still producing it
+@contextlib.contextmanager
+def stream(cmd, logger):
+    errPipe = lp.LogPipe(logger, logging.ERROR)
+    process = subprocess.Popen(cmd,
+                               shell=isinstance(cmd, str),
+                               stdin=subprocess.DEVNULL,
+                               stdout=subprocess.PIPE,
+                               stderr=errPipe,
+                               close_fds=True)
+    try:
+        yield process.stdout
+    finally:
+        process.stdout.close()
+        process.wait()
+        errPipe.close()
+
+        # also checked when consuming the output failed, a failing command
+        # usually is the reason its output could not be used
+        if process.returncode:
+            raise SubprocessException(cmd, process.returncode)
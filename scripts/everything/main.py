@@ -21,6 +21,7 @@ import logging
 import sys
 import time
 import os
+import atexit
 
 # local imports
 import execute as ex
@@ -132,8 +133,9 @@ if __name__ == '__main__':
         cluster.setupLogger(logCurrent, args.verbose)
     except Exception as e:
         logger.error("Could not establish cluster information!")
-        logger.error(e.msg)
+        logger.error(str(e))
         exit(1)
+    atexit.register(cluster.close)
     cluster.dump(logging.INFO)
     cluster.checkAuth()
 
@@ -0,0 +1,135 @@
+#!/usr/bin/python
+#
+# Copyright (c) 2018 University of Utah
+#
+# Permission to use, copy, modify, and distribute this software for any
+# purpose with or without fee is hereby granted, provided that the above
+# copyright notice and this permission notice appear in all copies.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR(S) DISCLAIM ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL AUTHORS BE LIABLE FOR
+# ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
+# ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
+# OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+
+import io
+import contextlib
+import logging
+import unittest
+import unittest.mock as mock
+
+# local imports
+import cluster as cl
+
+
+class HostPoolTest(unittest.TestCase):
+    def setUp(self):
+        self.pool = cl.HostPool()
+        self.hosts = [cl.Host('hp{:03}'.format(i), 'client{}'.format(i), 'host{}'.format(i))
+                      for i in range(4)]
+        for host in self.hosts:
+            self.pool.addHost(host)
+
+    def tearDown(self):
+        self.pool.close('user')
+
+    def test_execute_calls_each_host_once(self):
+        with mock.patch.object(cl.Host, 'execute', autospec=True) as execute:
+            self.pool.execute('user', 'true')
+
+        called = [call[0][0] for call in execute.call_args_list]
+        self.assertEqual(len(called), len(self.hosts))
+        self.assertEqual(set(map(id, called)), set(map(id, self.hosts)))
+        for call in execute.call_args_list:
+            self.assertEqual(call[0][1:], ('user', 'true'))
+
+
+class HostTest(unittest.TestCase):
+    def test_public_name_defaults_to_cloudlab(self):
+        host = cl.Host('hp174', 'server', 'server.exp.utah')
+        self.assertEqual(host.getPublicName(), 'hp174.utah.cloudlab.us')
+
+    def test_public_name_is_used_as_given(self):
+        for name in ['1.2.3.4', 'mycluster', 'hp174.wisc.cloudlab.us']:
+            host = cl.Host(name, 'manifest', name, publicName=name)
+            self.assertEqual(host.getPublicName(), name)
+
+    def test_master_per_user(self):
+        host = cl.Host('hp174', 'server', 'server.exp.utah')
+        done = mock.Mock(returncode=0)
+        with mock.patch.object(cl.subprocess, 'run', return_value=done) as run:
+            host.connect('alice')
+            host.connect('bob')
+            host.connect('alice')
+            host.close('alice')
+            host.close('bob')
+
+        paths = [next(arg for arg in call[0][0] if arg.startswith('ControlPath='))
+                 for call in run.call_args_list]
+        # two masters opened, then both closed, each with its own socket
+        self.assertEqual(len(paths), 4)
+        self.assertNotEqual(paths[0], paths[1])
+        self.assertEqual(paths[2:], paths[:2])
+
+
+MANIFEST = b'''<rspec xmlns="http://www.geni.net/resources/rspec/3"
+       xmlns:emulab="http://www.protogeni.net/resources/rspec/ext/emulab/1">
+  <node client_id="client0">
+    <interface client_id="client0:if0"/>
+    <emulab:vnode name="hp002"/>
+    <host name="client0.exp.utah.cloudlab.us"/>
+  </node>
+  <link client_id="link-0"><interface_ref client_id="client0:if0"/></link>
+  <node client_id="server">
+    <emulab:vnode name="hp001"/>
+    <host name="server.exp.utah.cloudlab.us"/>
+  </node>
+</rspec>
+'''
+
+
+class ClusterTest(unittest.TestCase):
+    def test_parses_manifest(self):
+        @contextlib.contextmanager
+        def stream(host, user, cmd):
+            yield io.BytesIO(MANIFEST)
+
+        with mock.patch.object(cl.Host, 'stream', stream):
+            cluster = cl.Cluster('user', 'hp174.utah.cloudlab.us')
+
+        with self.assertLogs('cluster', logging.INFO) as logs:
+            cluster.dump(logging.INFO)
+        output = '\n'.join(logs.output)
+        self.assertRegex(output, r'server:\n.*Name: hp001\n.*Id: server\n'
+                                 r'.*hostName: server.exp.utah.cloudlab.us\n'
+                                 r'.*clients:\n.*0:\n.*Name: hp002\n.*Id: client0')
+
+    def test_gateway_closed_when_manifest_fails(self):
+        failure = cl.ex.SubprocessException(['ssh', 'geni-get'], 255)
+        with mock.patch.object(cl.Host, 'stream', side_effect=failure), \
+                mock.patch.object(cl.Host, 'close', autospec=True) as close:
+            with self.assertRaises(cl.ex.SubprocessException):
+                cl.Cluster('user', 'hp174.utah.cloudlab.us')
+
+        close.assert_called_once_with(mock.ANY, 'user')
+
+
+class NicInfoTest(unittest.TestCase):
+    def test_parses_setup_output(self):
+        # output of the server setup script: git chatter, then the nic_info
+        # written by scripts/setup.py
+        output = ("Your branch is up to date with 'origin/master'.\n"
+                  "pci: 0000:04:00.1\n"
+                  "mac: 3c:fd:fe:04:9e:12\n")
+        nic = dict(cl.NIC_INFO_RE.findall(output))
+        self.assertEqual(nic, {'pci': '0000:04:00.1', 'mac': '3c:fd:fe:04:9e:12'})
+
+    def test_ignores_server_mac(self):
+        nic = dict(cl.NIC_INFO_RE.findall("server_mac: 3c:fd:fe:04:9e:12\n"))
+        self.assertEqual(nic, {})
+
+
+if __name__ == '__main__':
+    unittest.main()